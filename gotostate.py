@@ -1,9 +1,74 @@
 import argparse
+import io
 import json
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 import boto3
+from botocore.exceptions import ClientError
 
-client = boto3.client('stepfunctions')
+try:
+    # orjson parses and serializes JSON several times faster than the stdlib, which
+    # matters for large ASL definitions; fall back to stdlib json when unavailable
+    import orjson
+
+    _loads = orjson.loads
+
+    def _dumps(obj):
+        return orjson.dumps(obj).decode()
+except ImportError:
+    _loads = json.loads
+    _dumps = json.dumps
+
+try:
+    # ijson can stream a single field out of a large definition without building
+    # the whole object tree; it is optional like orjson above
+    import ijson
+except ImportError:
+    ijson = None
+
+# The Step Functions client is created on first use rather than at import time, so
+# callers that only need the pure string helpers never pay for endpoint resolution
+# and the credential chain walk
+_client = None
+
+
+def _get_client():
+    global _client
+    if _client is None:
+        _client = boto3.client('stepfunctions')
+    return _client
+
+
+# Matches the id of the failed event inside a 'States.Runtime' cause message, e.g.
+# "... 'Parallel 2' (entered at the event id #7) ..."; anchoring on 'event id #' keeps
+# digits in the state's own name from being mistaken for the id
+_FAILED_ID_RE = re.compile(r'event id #(\d+)')
+
+# Matches the ':execution:<machine>:<name>' tail of an execution Arn
+_EXECUTION_ARN_RE = re.compile(r':execution:([^:]+):[^:]+$')
+
+# Matches a "StartAt" field and captures its (still escaped) string value; only
+# trusted when the definition contains a single "StartAt" key
+_START_AT_RE = re.compile(r'"StartAt"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+# JSON fragment for the GoToState choice state; the structure is fixed, only the
+# Next/Default targets change per call, so the document is templated rather than
+# built as a dict and serialized every time
+_GO_TO_STATE_TEMPLATE = ('{{"Type":"Choice","Choices":[{{"Variable":"$.resuming",'
+                         '"BooleanEquals":false,"Next":{start}}}],"Default":{target}}}')
+
+# The only event types the failure-path walk needs to inspect; everything else
+# (TaskScheduled, LambdaFunctionSucceeded, ...) is the bulk of a history and can be
+# dropped at ingestion as long as its previousEventId pointer is kept
+_INTERESTING_EVENT_TYPES = frozenset({
+    'ExecutionFailed',
+    'ParallelStateFailed',
+    'TaskStateEntered',
+    'ParallelStateEntered',
+})
 
 
 def sm_arn_from_execution_arn(arn):
@@ -12,9 +77,102 @@ def sm_arn_from_execution_arn(arn):
     Input: Execution Arn of a state machine
     Output: Arn of the state machine
     """
-    sm_arn = arn.split(':')[:-1]
-    sm_arn[5] = 'stateMachine'
-    return ':'.join(sm_arn)
+    return _EXECUTION_ARN_RE.sub(r':stateMachine:\1', arn)
+
+
+def _definition_start_at(definition):
+    """
+    Get the top-level StartAt state name from an ASL definition string
+    When the definition contains a single "StartAt" key the value is read straight out
+    of the text with a regex, with no JSON parsing at all. Otherwise uses ijson, when
+    installed, to stream just that one field, or falls back to a full parse
+    Input definition - the ASL definition as a JSON string
+    Output - the name of the state the definition starts at
+    """
+    if definition.count('"StartAt"') == 1:
+        match = _START_AT_RE.search(definition)
+        if match is not None:
+            # Decode the captured value so escaped state names come back correctly
+            return _loads('"{}"'.format(match.group(1)))
+    if ijson is not None:
+        return next(ijson.items(io.StringIO(definition), 'StartAt'))
+    return _loads(definition)['StartAt']
+
+
+def _splice_go_to_state(definition, go_to_state):
+    """
+    Produce a new ASL definition with the GoToState added and StartAt pointing at it
+    When the definition contains exactly one "StartAt" and one "States" key, the new
+    document is built by string surgery on the original text, so the States tree is
+    never deserialized and reserialized. Nested Parallel branches carry their own
+    StartAt/States keys and make the text ambiguous; those definitions take the
+    parse-and-merge path instead
+    Input   definition - the original ASL definition as a JSON string
+            goToState - the GoToState choice state as a JSON string
+    Output - the new ASL definition as a JSON string
+    """
+    if definition.count('"StartAt"') == 1 and definition.count('"States"') == 1:
+        spliced = _START_AT_RE.sub('"StartAt":"GoToState"', definition, count=1)
+        # Inject the GoToState right after the opening brace of the States object
+        brace = spliced.index('{', spliced.index('"States"') + len('"States"'))
+        return (spliced[:brace + 1]
+                + '"GoToState":' + go_to_state + ','
+                + spliced[brace + 1:])
+    state_machine = _loads(definition)
+    return _dumps({
+        **state_machine,
+        'StartAt': 'GoToState',
+        'States': {'GoToState': _loads(go_to_state), **state_machine['States']}
+    })
+
+
+@lru_cache(maxsize=64)
+def _describe_sm(state_machine_arn):
+    """
+    Get the definition of a state machine, memoized by Arn
+    State machine definitions rarely change within a session, so repeated calls for the
+    same Arn (warm Lambda invocations, batch recovery of many executions) reuse the
+    response instead of repeating the API round-trip
+    Input stateMachineArn - a string containing the Arn of a state machine
+    Output - the describe_state_machine response for that state machine
+    """
+    return _get_client().describe_state_machine(stateMachineArn=state_machine_arn)
+
+
+def _iter_events_reverse(execution_arn, include_execution_data=True):
+    """
+    Lazily yield the events of an execution history, newest first
+    Pages of the history are only fetched from the API as the caller consumes them, so a
+    caller that stops iterating early never pays for the remaining pages
+    Input   executionArn - a string containing the execution Arn of a state machine
+            includeExecutionData - whether events should carry their input/output
+            payloads; pass False for scans that only look at event structure
+    Output - a generator of execution history events in reverse order
+    """
+    paginator = _get_client().get_paginator('get_execution_history')
+    pages = paginator.paginate(
+        executionArn=execution_arn,
+        reverseOrder=True,
+        includeExecutionData=include_execution_data,
+        PaginationConfig={'PageSize': 1000}
+    )
+    for page in pages:
+        yield from page['events']
+
+
+def _state_entered_input(execution_arn, event_id):
+    """
+    Fetch the input recorded on a single state-entered event
+    The failure-path scan runs with execution data stripped to keep pages small, so once
+    the failed state's event id is known, this re-reads the history with data included
+    and stops at the requested event
+    Input   executionArn - a string containing the execution Arn of a state machine
+            eventId - the id of a *StateEntered event in that history
+    Output - the input to the state, as a JSON string
+    """
+    for event in _iter_events_reverse(execution_arn):
+        if event['id'] == event_id:
+            return event['stateEnteredEventDetails']['input']
 
 
 def parse_failure_history(failed_execution_arn):
@@ -25,89 +183,92 @@ def parse_failure_history(failed_execution_arn):
     Output - a list with two elements: [name of failed state, input to failed state]
     """
 
-    failed_events = list()
     failed_at_parallel_state = False
 
-    try:
-        # Get the execution history
-        response = client.get_execution_history(
-            executionArn=failed_execution_arn,
-            reverseOrder=True
-        )
-        next_token = response.get('nextToken')
-        failed_events.extend(response['events'])
-    except Exception as ex:
-        raise ex
-
-    while next_token is not None:
-        try:
-            # Get the execution history
-            response = client.get_execution_history(
-                executionArn=failed_execution_arn,
-                reverseOrder=True,
-                nextToken=next_token
-            )
-            next_token = response.get('nextToken')
-            failed_events.extend(response['events'])
-        except Exception as ex:
-            raise ex
-
-    # Confirm that the execution actually failed, raise exception if it didn't fail
-    try:
-        failed_events[0]['executionFailedEventDetails']
-    except Exception as cause:
-        raise Exception('Execution did not fail', cause)
+    # Confirm that the execution actually failed before touching its history; one small
+    # describe_execution call rejects RUNNING/SUCCEEDED/ABORTED Arns without any paging
+    status = _get_client().describe_execution(executionArn=failed_execution_arn)['status']
+    if status != 'FAILED':
+        raise RuntimeError('Execution status is {}, not FAILED'.format(status))
+
+    # Scan without input/output payloads; only the failed state's input is fetched, once
+    events = _iter_events_reverse(failed_execution_arn, include_execution_data=False)
+    latest_event = next(events, None)
+
+    failure_details = latest_event.get('executionFailedEventDetails') if latest_event else None
+    if failure_details is None:
+        raise RuntimeError('Execution did not fail')
     '''
     If we have a 'States.Runtime' error (for example if a task state in our state
     machine attempts to execute a lambda function in a different region than the
     state machine, get the id of the failed state, use id of the failed state to
     determine failed state name and input
     '''
-    if failed_events[0]['executionFailedEventDetails']['error'] == 'States.Runtime':
-        failed_id = int(filter(str.isdigit, str(failed_events[0]['executionFailedEventDetails']['cause'].split()[13])))
-        failed_state = failed_events[-1 * failed_id]['stateEnteredEventDetails']['name']
-        failed_input = failed_events[-1 * failed_id]['stateEnteredEventDetails']['input']
-        return failed_state, failed_input
+    if failure_details['error'] == 'States.Runtime':
+        id_match = _FAILED_ID_RE.search(failure_details['cause'])
+        if id_match is None:
+            raise RuntimeError('Could not find a failed event id in the States.Runtime '
+                               'cause message: {}'.format(failure_details['cause']))
+        failed_id = int(id_match.group(1))
+        for event in events:
+            if event['id'] == failed_id:
+                failed_state = event['stateEnteredEventDetails']['name']
+                failed_input = _state_entered_input(failed_execution_arn, failed_id)
+                return failed_state, failed_input
+        raise RuntimeError('Could not find event id {} in the history of execution {}'.format(
+            failed_id, failed_execution_arn))
     '''
     We need to loop through the execution history, tracing back the executed steps
     The first state we encounter will be the failed state
     If we failed on a parallel state, we need the name of the parallel state rather than the
     name of a state within a parallel state it failed on. This is because we can only attach
     the goToState to the parallel state, but not a sub-state within the parallel state.
-    This loop starts with the id of the latest event and uses the previous event id's to trace
-    back the execution to the beginning (id 0). However, it will return as soon it finds the name
-    of the failed state
+    Because the history is consumed newest-first, we follow the previous event id's back
+    towards the beginning, skipping events that are not on the failure path, and we stop
+    fetching history pages as soon as we find the name of the failed state
     '''
-    current_event_id = failed_events[0]['id']
-    while current_event_id != 0:
-        # multiply event id by -1 for indexing because we're looking at the reversed history
-        current_event = failed_events[-1 * current_event_id]
-        '''
-        We can determine if the failed state was a parallel state because it an event
-        with 'type'='ParallelStateFailed' will appear in the execution history before
-        the name of the failed state
-        '''
-        if current_event['type'] == 'ParallelStateFailed':
-            failed_at_parallel_state = True
-        '''
-        If the failed state is not a parallel state, then the name of failed state to return
-        will be the name of the state in the first 'TaskStateEntered' event type we run into
-        when tracing back the execution history
-        '''
-        if current_event['type'] == 'TaskStateEntered' and not failed_at_parallel_state:
-            failed_state = current_event['stateEnteredEventDetails']['name']
-            failed_input = current_event['stateEnteredEventDetails']['input']
-            return failed_state, failed_input
-        '''
-        If the failed state was a parallel state, then we need to trace execution back to
-        the first event with 'type'='ParallelStateEntered', and return the name of the state
-        '''
-        if current_event['type'] == 'ParallelStateEntered' and failed_at_parallel_state:
-            failed_state = current_event['stateEnteredEventDetails']['name']
-            failed_input = current_event['stateEnteredEventDetails']['input']
-            return failed_state, failed_input
-        # Update the id for the next execution of the loop
-        current_event_id = current_event['previousEventId']
+    current_event_id = latest_event['previousEventId']
+    # Full records for the event types the walk inspects, and bare previousEventId
+    # pointers for everything else, so most of the history is never retained
+    by_id = {}
+    prev = {}
+    for event in events:
+        # Index events by id so the walk below does not depend on the order pages arrive in
+        prev[event['id']] = event['previousEventId']
+        if event['type'] in _INTERESTING_EVENT_TYPES:
+            by_id[event['id']] = event
+        # Follow the failure path as far as the events fetched so far allow
+        while current_event_id in prev:
+            current_event = by_id.pop(current_event_id, None)
+            current_event_id = prev.pop(current_event_id)
+            if current_event is None:
+                continue
+            '''
+            We can determine if the failed state was a parallel state because it an event
+            with 'type'='ParallelStateFailed' will appear in the execution history before
+            the name of the failed state
+            '''
+            if current_event['type'] == 'ParallelStateFailed':
+                failed_at_parallel_state = True
+            '''
+            If the failed state is not a parallel state, then the name of failed state to return
+            will be the name of the state in the first 'TaskStateEntered' event type we run into
+            when tracing back the execution history
+            '''
+            if current_event['type'] == 'TaskStateEntered' and not failed_at_parallel_state:
+                failed_state = current_event['stateEnteredEventDetails']['name']
+                failed_input = _state_entered_input(failed_execution_arn, current_event['id'])
+                return failed_state, failed_input
+            '''
+            If the failed state was a parallel state, then we need to trace execution back to
+            the first event with 'type'='ParallelStateEntered', and return the name of the state
+            '''
+            if current_event['type'] == 'ParallelStateEntered' and failed_at_parallel_state:
+                failed_state = current_event['stateEnteredEventDetails']['name']
+                failed_input = _state_entered_input(failed_execution_arn, current_event['id'])
+                return failed_state, failed_input
+    raise RuntimeError('Could not find the failed state in the history of execution {}'.format(
+        failed_execution_arn))
 
 
 def attach_go_to_state(failed_state_name, state_machine_arn):
@@ -121,54 +282,82 @@ def attach_go_to_state(failed_state_name, state_machine_arn):
     Output  response from the create_state_machine call, which is the API call that creates a new state machine
     """
     try:
-        response = client.describe_state_machine(
-            stateMachineArn=state_machine_arn
-        )
-    except Exception as cause:
-        raise Exception('Could not get ASL definition of state machine', cause)
+        response = _describe_sm(state_machine_arn)
+    except ClientError as cause:
+        raise RuntimeError('Could not get ASL definition of state machine') from cause
     role_arn = response['roleArn']
-    state_machine = json.loads(response['definition'])
+    definition = response['definition']
     # Create a name for the new state machine
     new_name = response['name'] + '-with-GoToState'
     # Get the StartAt state for the original state machine, because we will point the 'GoToState' to this state
-    original_start_at = state_machine['StartAt']
+    original_start_at = _definition_start_at(definition)
     '''
     Create the GoToState with the variable $.resuming
     If new state machine is executed with $.resuming = True, then the state machine will skip to the failed state
     Otherwise, it will execute the state machine from the original start state
     '''
-    go_to_state = {
-        'Type': 'Choice',
-        'Choices': [{'Variable': '$.resuming', 'BooleanEquals': False, 'Next': original_start_at}],
-        'Default': failed_state_name
-    }
-    # Add GoToState to the set of states in the new state machine
-    state_machine['States']['GoToState'] = go_to_state
-    # Add StartAt
-    state_machine['StartAt'] = 'GoToState'
+    go_to_state = _GO_TO_STATE_TEMPLATE.format(
+        start=json.dumps(original_start_at),
+        target=json.dumps(failed_state_name)
+    )
+    # Splice the GoToState into the definition and point StartAt at it
+    new_definition = _splice_go_to_state(definition, go_to_state)
     # Create new state machine
     try:
-        response = client.create_state_machine(
+        response = _get_client().create_state_machine(
             name=new_name,
-            definition=json.dumps(state_machine),
+            definition=new_definition,
             roleArn=role_arn
         )
-    except Exception as cause:
-        raise Exception('Failed to create new state machine with GoToState', cause)
+    except ClientError as cause:
+        raise RuntimeError('Failed to create new state machine with GoToState') from cause
     return response
 
 
+def recover_execution(failed_execution_arn):
+    """
+    Run the whole recovery pipeline for one failed execution: find the failed state,
+    then create the '-with-GoToState' copy of its state machine
+    Input failedExecutionArn - a string containing the execution Arn of a failed state machine
+    Output - a tuple of (new state machine Arn, failed state name, input to the failed state)
+    """
+    failed_sm_state, failed_sm_info = parse_failure_history(failed_execution_arn)
+    failed_sm_arn = sm_arn_from_execution_arn(failed_execution_arn)
+    new_machine = attach_go_to_state(failed_sm_state, failed_sm_arn)
+    return new_machine['stateMachineArn'], failed_sm_state, failed_sm_info
+
+
+log = logging.getLogger(__name__)
+
+
 if __name__ == '__main__':
     '''
     Main
     Run as:
     python gotostate.py --failedExecutionArn '<Failed_Execution_Arn>'"
+    or, to recover several failed executions concurrently:
+    python gotostate.py --failedExecutionArns '<Arn_1>' '<Arn_2>' ...
     '''
-    parser = argparse.ArgumentParser(description='Execution Arn of the failed state machine.')
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    parser = argparse.ArgumentParser(description='Execution Arn(s) of the failed state machine(s).')
     parser.add_argument('--failedExecutionArn', dest='failedExecutionArn', type=str)
+    parser.add_argument('--failedExecutionArns', dest='failedExecutionArns', type=str, nargs='+',
+                        help='execution Arns of several failed state machines to recover concurrently')
+    parser.add_argument('--concurrency', dest='concurrency', type=int, default=8,
+                        help='number of executions to recover in parallel (default 8)')
     args = parser.parse_args()
-    failed_sm_state, failed_sm_info = parse_failure_history(args.failedExecutionArn)
-    failed_sm_arn = sm_arn_from_execution_arn(args.failedExecutionArn)
-    new_machine = attach_go_to_state(failed_sm_state, failed_sm_arn)
-    print("New State Machine Arn: {}".format(new_machine['stateMachineArn']))
-    print("Execution had failed at state: {} with Input: {}".format(failed_sm_state, failed_sm_info))
+    arns = args.failedExecutionArns or []
+    if args.failedExecutionArn:
+        arns.append(args.failedExecutionArn)
+    if not arns:
+        parser.error('one of --failedExecutionArn or --failedExecutionArns is required')
+    '''
+    Recovery is entirely network-bound, so many executions are processed on a thread
+    pool; boto3 clients are thread-safe and executions from the same state machine
+    share the memoized describe_state_machine response
+    '''
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for new_machine_arn, failed_sm_state, failed_sm_info in executor.map(recover_execution, arns):
+            # %s-style arguments are only stringified if the handler actually emits the record
+            log.info('New State Machine Arn: %s', new_machine_arn)
+            log.info('Execution had failed at state: %s with Input: %s', failed_sm_state, failed_sm_info)